@@ -0,0 +1,33 @@
+# backend/_search.py
+
+from typing import Dict, List, Tuple
+
+
+def build_search_blob(annotations: Dict[str, Dict]) -> Tuple[List[str], List[str]]:
+    """
+    Flatten the annotations into parallel lists of UIDs and search blobs.
+    Each blob is the lowercased name, tags and categories of one object,
+    NUL-separated so a keyword never matches across two fields.
+    """
+    uids = list(annotations)
+    blobs = []
+    append = blobs.append
+    join = "\x00".join
+    for annotation in annotations.values():
+        fields = [annotation.get('name', '')]
+        for tag in annotation.get('tags', ()):
+            fields.append(tag['name'])
+        for category in annotation.get('categories', ()):
+            fields.append(category['name'])
+        append(join(fields).lower())
+    return uids, blobs
+
+
+def build_token_index(uids: List[str], blobs: List[str]) -> Dict[str, List[str]]:
+    """Map each whitespace-separated token of the search blobs to the UIDs containing it."""
+    index = {}
+    setdefault = index.setdefault
+    for uid, blob in zip(uids, blobs):
+        for token in set(blob.replace("\x00", " ").split()):
+            setdefault(token, []).append(uid)
+    return index
@@ -1,25 +1,35 @@
 # backend/app.py
 
 import os
+import orjson
 import shutil
+import asyncio
+import threading
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
 from fastapi.staticfiles import StaticFiles
 from dotenv import load_dotenv
 import openai
 import objaverse
-from typing import Optional, List, Dict
+from typing import Any, Optional, List, Dict
 import logging
 import traceback
 import random
-import PIL.Image
-import requests
-from io import BytesIO
+import re
+import pyarrow as pa
+import pyarrow.compute as pc
+import httpx
+import diskcache
 from typing import Tuple
+from functools import lru_cache
 
 import google.generativeai as genai
 
+from _search import build_search_blob, build_token_index
+
 # Configure Logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -43,27 +53,58 @@ DOWNLOAD_DIR = os.path.expanduser("~/.objaverse")
 if not os.path.exists(DOWNLOAD_DIR):
     os.makedirs(DOWNLOAD_DIR)
 
+# Persisted UID -> local path map of objects that were already downloaded
+PATH_CACHE_FILE = os.path.join(DOWNLOAD_DIR, "path_cache.json")
+path_cache_lock = threading.Lock()
+
+# Gemini ratings keyed by "<uid>|<object type>|<theme>", shared across sessions
+rating_cache = diskcache.Cache(os.path.join(DOWNLOAD_DIR, "rating_cache"))
+
+# Maximum number of processes used to download a batch of objects
+MAX_DOWNLOAD_PROCESSES = 8
+
+# gltf-transform CLI used to Draco-compress downloaded GLBs, if installed
+GLTF_TRANSFORM = shutil.which("gltf-transform")
+
 # Mount the download directory to serve static files
 app.mount("/downloads", StaticFiles(directory=DOWNLOAD_DIR), name="downloads")
 
 # Global variable to store UIDs and annotations
-uids = []
+uid_list: List[str] = []
 annotations = {}
 lvis_annotations = {}
+downloaded_paths: Dict[str, str] = {}
 
-# Load UIDs and annotations on startup
+# Keyword search structures, built once from the annotations at startup.
+# search_array holds one lowercased NUL-joined blob per entry of uid_array.
+uid_array = pa.array([], type=pa.string())
+search_array = pa.array([], type=pa.string())
+token_index: Dict[str, List[str]] = {}
+token_array = pa.array([], type=pa.string())
+
+# Bound concurrent Gemini rating requests to respect the API rate limits
+rating_semaphore = asyncio.Semaphore(16)
+
+# One "<image number> | <rating> | <explanation>" line of a batched rating response
+RATING_LINE = re.compile(r"^\s*(\d+)\s*\|\s*(\d+(?:\.\d+)?)\s*\|?\s*(.*)$")
+
+# Load annotations on startup
 @app.on_event("startup")
 def setup():
-    global uids, annotations, lvis_annotations
+    global uid_list, annotations, lvis_annotations, downloaded_paths
     try:
-        logger.info("Loading Objaverse UIDs...")
-        uids = objaverse.load_uids()
-        logger.info(f"Loaded {len(uids)} UIDs.")
+        downloaded_paths = load_path_cache()
+        logger.info(f"Loaded {len(downloaded_paths)} cached object paths.")
         
         logger.info("Loading Objaverse annotations...")
         annotations = objaverse.load_annotations()
+        uid_list = list(annotations)
         logger.info(f"Loaded annotations for {len(annotations)} objects.")
         
+        logger.info("Building keyword search index...")
+        build_search_index()
+        logger.info(f"Indexed {len(token_index)} unique tokens.")
+        
         logger.info("Loading LVIS annotations...")
         lvis_annotations = objaverse.load_lvis_annotations()
         logger.info(f"Loaded LVIS annotations for {len(lvis_annotations)} categories.")
@@ -72,32 +113,72 @@ def setup():
         logger.error(f"Error loading Objaverse data: {e}")
 
 
+@app.on_event("startup")
+async def open_http_client():
+    """Create the shared HTTP client used to fetch thumbnails."""
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        timeout=10.0,
+        limits=httpx.Limits(max_connections=32, max_keepalive_connections=16)
+    )
+
+
+@app.on_event("shutdown")
+async def close_http_client():
+    """Close the shared HTTP client."""
+    await app.state.http.aclose()
+
+
+def build_search_index() -> None:
+    """
+    Precompute one lowercased name/tag/category blob per object as a columnar
+    Arrow array, so searches run as vectorized substring kernels, and an
+    inverted index mapping each whitespace-separated token to UIDs.
+    """
+    global uid_array, search_array, token_index, token_array
+    ordered_uids, blobs = build_search_blob(annotations)
+    uid_array = pa.array(ordered_uids, type=pa.string())
+    search_array = pa.array(blobs, type=pa.string())
+    token_index = build_token_index(ordered_uids, blobs)
+    token_array = pa.array(list(token_index), type=pa.string())
+    find_matching_uids.cache_clear()
+
+
+@lru_cache(maxsize=4096)
+def find_matching_uids(keyword: str) -> Tuple[str, ...]:
+    """
+    Return the UIDs whose name, tags or categories contain the lowercased keyword.
+    Single-word keywords only scan the token vocabulary; keywords containing
+    whitespace fall back to scanning the per-object search blobs.
+    """
+    if keyword.split() != [keyword]:
+        mask = pc.match_substring(search_array, keyword)
+        return tuple(pc.filter(uid_array, mask).to_pylist())
+    
+    # A whitespace-free keyword can only occur inside a single token
+    matches = set()
+    for token in pc.filter(token_array, pc.match_substring(token_array, keyword)).to_pylist():
+        matches.update(token_index[token])
+    return tuple(matches)
+
+
 def find_relevant_object_keyword(prompt: str) -> Optional[str]:
     """
     Perform a keyword-based search to find a relevant object.
     Returns a single object UID if found, else selects a random one.
     """
-    if not uids:
+    if not uid_list:
         logger.error("No objects found.")
         return None
     
     # Lowercase the prompt
     keyword = prompt.lower()
     
-    # Search in object names and tags
-    relevant_uids = []
-    for uid, annotation in annotations.items():
-        
-        name = annotation.get('name', '').lower()
-        tags = [tag['name'].lower() for tag in annotation.get('tags', [])]
-        categories = [cat['name'].lower() for cat in annotation.get('categories', [])]
-        
-        if (keyword in name or 
-            any(keyword in tag for tag in tags) or 
-            any(keyword in category for category in categories)):
-            relevant_uids.append(uid)
+    # Search in object names, tags and categories
+    relevant_uids = find_matching_uids(keyword)
     
-    # If results found, return a random one from the relevant set
+    # If results found, return a random one from the relevant set. The hits are
+    # a cached tuple, so this is a uniform O(1) pick without rescanning.
     if relevant_uids:
         selected_uid = random.choice(relevant_uids)
         logger.info(f"Found object matching the keyword: {selected_uid}")
@@ -105,91 +186,207 @@ def find_relevant_object_keyword(prompt: str) -> Optional[str]:
     else:
         # If no matches, select a random object
         logger.warning(f"No relevant objects found for keyword '{keyword}'. Selecting a random object.")
-        return random.choice(uids)
+        return random.choice(uid_list)
 
-def get_image_from_url(url: str):
-    """Downloads and returns an image as a PIL Image."""
+async def get_image_from_url(url: str) -> Optional[Dict]:
+    """Downloads an image and returns it as an inline blob for Gemini."""
     try:
-        response = requests.get(url)
+        response = await app.state.http.get(url)
         response.raise_for_status()
-        return PIL.Image.open(BytesIO(response.content))
+        mime_type = response.headers.get("content-type", "image/jpeg").split(";")[0].strip()
+        return {"mime_type": mime_type, "data": response.content}
     except Exception as e:
         logger.error(f"Error downloading image from {url}: {e}")
         return None
 
-async def rate_object_fit(url: str, object_type: str, theme: str) -> Tuple[float, str]:
-    """Rate how well an object fits the theme and its functionality."""
-    try:
-        image = get_image_from_url(url)
-        if not image:
-            return (0, "Failed to load image")
+async def rate_candidates(uids: List[str], urls: List[str], object_type: str, theme: str) -> List[Tuple[float, str]]:
+    """
+    Rate how well each candidate object fits the theme and its functionality.
+    Ratings are cached per object, type and theme; the thumbnails of the
+    uncached candidates are sent to Gemini in a single request.
+    """
+    keys = [f"{uid}|{object_type}|{theme}" for uid in uids]
+    ratings = [rating_cache.get(key) for key in keys]
+    pending = [i for i, rating in enumerate(ratings) if rating is None]
+    if not pending:
+        return ratings
 
+    try:
         api_key = os.getenv("GOOGLE_API_KEY")
         if not api_key:
             raise Exception("Google API key not found")
         
         genai.configure(api_key=api_key)
         model = genai.GenerativeModel("gemini-1.5-pro")
-        
-        prompt = f"""
-        Rate this {object_type} for a {theme} room on a scale of 1-5:
+
+        async with rating_semaphore:
+            images = await asyncio.gather(*[get_image_from_url(urls[i]) for i in pending])
+            for i, image in zip(pending, images):
+                ratings[i] = (0, "No rating returned") if image else (0, "Failed to load image")
+            loaded = [(i, image) for i, image in zip(pending, images) if image]
+            if not loaded:
+                return ratings
+
+            prompt = f"""
+        Rate each of these {len(loaded)} images of a {object_type} for a {theme} room on a scale of 1-5:
         1. How well does it fit the {theme} theme? (0-5)
         2. How well does it function as a {object_type}? (0-5)
 
-        Format your response exactly like this:
-        3.5
-        Good match for theme, proper functionality as a {object_type}
+        Reply with one line per image, in the order given, formatted exactly like this:
+        1 | 3.5 | Good match for theme, proper functionality as a {object_type}
         """
 
-        response = model.generate_content([prompt, image])
-        lines = response.text.strip().split('\n', 1)
-        rating = float(lines[0])
-        explanation = lines[1] if len(lines) > 1 else ""
+            response = await model.generate_content_async([prompt, *[image for _, image in loaded]])
+
+        for line in response.text.strip().split('\n'):
+            match = RATING_LINE.match(line)
+            if not match:
+                continue
+            position = int(match.group(1)) - 1
+            if 0 <= position < len(loaded):
+                i = loaded[position][0]
+                ratings[i] = (float(match.group(2)), match.group(3).strip())
+                rating_cache[keys[i]] = ratings[i]
         
-        return (rating, explanation)
+        return ratings
         
     except Exception as e:
-        logger.error(f"Error rating object: {e}")
-        return (0, f"Error: {str(e)}")
+        logger.error(f"Error rating objects: {e}")
+        for i in pending:
+            ratings[i] = (0, f"Error: {str(e)}")
+        return ratings
 
-def download_object(uid: str) -> Optional[str]:
+def load_path_cache() -> Dict[str, str]:
+    """Load the persisted UID -> local path map, or an empty one if unavailable."""
+    try:
+        with open(PATH_CACHE_FILE, 'rb') as file:
+            return orjson.loads(file.read())
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable path cache {PATH_CACHE_FILE}: {e}")
+        return {}
+
+def save_path_cache() -> None:
+    """Persist the UID -> local path map so restarts keep the cache warm."""
+    tmp_path = f"{PATH_CACHE_FILE}.tmp"
+    with open(tmp_path, 'wb') as file:
+        file.write(orjson.dumps(downloaded_paths))
+    os.replace(tmp_path, PATH_CACHE_FILE)
+
+def compress_glb(local_path: str) -> str:
     """
-    Download a single Objaverse object and return its local path.
+    Return the path of a Draco-compressed copy of a downloaded GLB, creating it
+    next to the original on first use. Falls back to the original file when
+    gltf-transform is not installed or the conversion fails.
     """
+    if not GLTF_TRANSFORM:
+        return local_path
+
+    root, ext = os.path.splitext(local_path)
+    compressed_path = f"{root}.draco{ext}"
+    if os.path.exists(compressed_path):
+        return compressed_path
+
+    # A unique temp file per conversion, so concurrent requests for the same
+    # object can't write into each other's output before it is moved into place
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(local_path), suffix=ext)
+    os.close(fd)
     try:
-        objects_to_download = {uid: annotations[uid]}
-        downloaded = objaverse.load_objects(uids=[uid])
-        local_path = downloaded.get(uid)
-        if local_path and os.path.exists(local_path):
-            logger.info(f"Successfully downloaded object: {uid} to {local_path}")
-            return local_path
-        else:
-            logger.warning(f"Download failed or file does not exist for object: {uid}")
-            return None
+        subprocess.run(
+            [GLTF_TRANSFORM, "draco", local_path, tmp_path, "--quantize-position", "14"],
+            check=True,
+            capture_output=True,
+            timeout=300
+        )
+        os.replace(tmp_path, compressed_path)
+        logger.info(f"Compressed {local_path} to {compressed_path}")
+        return compressed_path
     except Exception as e:
-        logger.error(f"Error downloading object {uid}: {e}")
-        logger.error(traceback.format_exc())
-        return None
+        logger.warning(f"Draco compression failed for {local_path}, serving original: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return local_path
+
+def compress_glbs(local_paths: Dict[str, str]) -> Dict[str, str]:
+    """Draco-compress a batch of downloaded GLBs in parallel."""
+    if not GLTF_TRANSFORM:
+        return local_paths
+    with ThreadPoolExecutor(max_workers=MAX_DOWNLOAD_PROCESSES) as executor:
+        return dict(zip(local_paths, executor.map(compress_glb, local_paths.values())))
+
+def download_objects(uids: List[str]) -> Dict[str, str]:
+    """
+    Download several Objaverse objects and return a map of UID to the local
+    path to serve (Draco-compressed when possible). Objects already on disk are
+    served from the path cache; the rest are fetched with a single
+    objaverse.load_objects call using parallel processes.
+    """
+    local_paths = {}
+    missing = []
+    for uid in dict.fromkeys(uids):
+        cached_path = downloaded_paths.get(uid)
+        if cached_path and os.path.exists(cached_path):
+            local_paths[uid] = cached_path
+        else:
+            missing.append(uid)
+
+    if missing:
+        try:
+            downloaded = objaverse.load_objects(
+                uids=missing,
+                download_processes=min(len(missing), MAX_DOWNLOAD_PROCESSES)
+            )
+        except Exception as e:
+            logger.error(f"Error downloading objects {missing}: {e}")
+            logger.error(traceback.format_exc())
+            downloaded = {}
+
+        new_paths = {}
+        for uid in missing:
+            local_path = downloaded.get(uid)
+            if local_path and os.path.exists(local_path):
+                logger.info(f"Successfully downloaded object: {uid} to {local_path}")
+                new_paths[uid] = local_path
+            else:
+                logger.warning(f"Download failed or file does not exist for object: {uid}")
+
+        if new_paths:
+            with path_cache_lock:
+                downloaded_paths.update(new_paths)
+                save_path_cache()
+        local_paths.update(new_paths)
+
+    return compress_glbs(local_paths)
+
+def download_object(uid: str) -> Optional[str]:
+    """
+    Download a single Objaverse object and return its local path.
+    """
+    return download_objects([uid]).get(uid)
 
 @app.post("/generate_scene")
-async def generate_scene(request: Request):
+async def generate_scene(request: Request) -> Dict[str, Any]:
     """
     Endpoint to generate a 3D scene based on a user prompt.
     Expects a JSON payload with a 'prompt' field.
     """
     try:
-        data = await request.json()
+        try:
+            data = orjson.loads(await request.body())
+        except orjson.JSONDecodeError:
+            raise HTTPException(status_code=400, detail="Invalid JSON body.")
         prompt = data.get("prompt", "").strip()
         if not prompt:
             raise HTTPException(status_code=400, detail="Prompt is required.")
 
         # Step 1: Perform keyword-based search
-        selected_uid = find_relevant_object_keyword(prompt)
+        selected_uid = await asyncio.to_thread(find_relevant_object_keyword, prompt)
         if selected_uid is None:
             raise HTTPException(status_code=404, detail="No objects available to generate the scene.")
 
         # Step 2: Attempt to download the selected object
-        downloaded_path = download_object(selected_uid)
+        downloaded_path = await asyncio.to_thread(download_object, selected_uid)
         if not downloaded_path:
             raise HTTPException(status_code=500, detail="Failed to download the selected object.")
 
@@ -198,7 +395,7 @@ async def generate_scene(request: Request):
         file_url = f"/downloads/{relative_path.replace(os.sep, '/')}"
         
         object_annotation = annotations.get(selected_uid, {})
-        print(object_annotation)
+        logger.debug("Selected annotation uid=%s", selected_uid)
         response = {
             "uid": selected_uid,
             "name": object_annotation.get('name', ''),
@@ -208,7 +405,7 @@ async def generate_scene(request: Request):
             "categories": [cat['name'] for cat in object_annotation.get('categories', [])]
         }
 
-        return JSONResponse(content=response)
+        return response
 
     except HTTPException as he:
         logger.error(f"HTTPException: {he.detail}")
@@ -220,7 +417,7 @@ async def generate_scene(request: Request):
     
 
 @app.post("/gemini_call")
-async def gemini_call(request: Request) -> Dict:
+async def gemini_call(request: Request) -> Dict[str, Any]:
     """
     Endpoint to prompt Gemini API.
     Expects a JSON body with a "prompt" field.
@@ -228,7 +425,10 @@ async def gemini_call(request: Request) -> Dict:
     """
     try:
         # Get the request body
-        body = await request.json()
+        try:
+            body = orjson.loads(await request.body())
+        except orjson.JSONDecodeError:
+            raise HTTPException(status_code=400, detail="Invalid JSON body")
         prompt = body.get("prompt")
         
         if not prompt:
@@ -263,7 +463,7 @@ async def gemini_call(request: Request) -> Dict:
         )
     
 @app.get("/initialize_scene")
-async def initialize_scene():
+async def initialize_scene() -> Dict[str, Any]:
     """Initialize the scene with theme-appropriate objects."""
     try:
         # Select random theme
@@ -340,20 +540,14 @@ async def initialize_scene():
 
         scene_objects = []
         
-        # Process each object
-        for item in objects:
-            # Get 5 random matching objects
-            relevant_uids = []
-            for uid, annotation in annotations.items():
-                name = annotation.get('name', '').lower()
-                tags = [tag['name'].lower() for tag in annotation.get('tags', [])]
-                categories = [cat['name'].lower() for cat in annotation.get('categories', [])]
-                
-                if (item["keyword"] in name or 
-                    any(item["keyword"] in tag for tag in tags) or 
-                    any(item["keyword"] in category for category in categories)):
-                    relevant_uids.append(uid)
-
+        # Collect up to 5 random candidates with a thumbnail for each object
+        candidates = {}
+        # Look up every keyword in one go off the event loop, since a cold
+        # multi-word keyword scans every annotation
+        slot_matches = await asyncio.to_thread(
+            lambda: [find_matching_uids(item["keyword"]) for item in objects]
+        )
+        for item_index, (item, relevant_uids) in enumerate(zip(objects, slot_matches)):
             if not relevant_uids:
                 logger.warning(f"No objects found for {item['keyword']}")
                 continue
@@ -361,11 +555,6 @@ async def initialize_scene():
             # Take up to 5 random objects
             sample_uids = random.sample(relevant_uids, min(5, len(relevant_uids)))
             
-            # Rate each object
-            best_rating = 0
-            best_uid = None
-            best_explanation = ""
-            
             for uid in sample_uids:
                 # Get first thumbnail URL
                 thumbnails = annotations[uid].get('thumbnails', {}).get('images', [])
@@ -376,42 +565,63 @@ async def initialize_scene():
                 if not image_url:
                     continue
                 
-                rating, explanation = await rate_object_fit(
-                    image_url, 
-                    item["keyword"],
-                    theme
-                )
-                
+                candidates.setdefault(item_index, []).append((uid, image_url))
+
+        # Rate each object's candidates in one request, all objects concurrently
+        slots = list(candidates)
+        slot_ratings = await asyncio.gather(*[
+            rate_candidates(
+                [uid for uid, _ in candidates[item_index]],
+                [image_url for _, image_url in candidates[item_index]],
+                objects[item_index]["keyword"],
+                theme
+            )
+            for item_index in slots
+        ])
+
+        # Keep the best rated candidate for each object
+        best_candidates = {}
+        for item_index, ratings in zip(slots, slot_ratings):
+            for (uid, _), (rating, explanation) in zip(candidates[item_index], ratings):
+                best_rating = best_candidates.get(item_index, (0,))[0]
                 if rating > best_rating:
-                    best_rating = rating
-                    best_uid = uid
-                    best_explanation = explanation
-
-            # If we found a good object, add it to the scene
-            if best_uid:
-                downloaded_path = download_object(best_uid)
-                if not downloaded_path:
-                    continue
+                    best_candidates[item_index] = (rating, uid, explanation)
 
-                relative_path = os.path.relpath(downloaded_path, DOWNLOAD_DIR)
-                file_url = f"/downloads/{relative_path.replace(os.sep, '/')}"
-                
-                object_annotation = annotations.get(best_uid, {})
-                scene_objects.append({
-                    "uid": best_uid,
-                    "name": object_annotation.get('name', ''),
-                    "fileURL": file_url,
-                    "position": item["position"],
-                    "rotation": item["rotation"],
-                    "type": item["keyword"],
-                    "rating": best_rating,
-                    "explanation": best_explanation
-                })
-
-        return JSONResponse(content={
+        # Download all chosen objects in one batch off the event loop
+        local_paths = await asyncio.to_thread(
+            download_objects,
+            [best_uid for _, best_uid, _ in best_candidates.values()]
+        )
+
+        # Add the best rated object for each slot to the scene
+        for item_index, item in enumerate(objects):
+            if item_index not in best_candidates:
+                continue
+            best_rating, best_uid, best_explanation = best_candidates[item_index]
+
+            downloaded_path = local_paths.get(best_uid)
+            if not downloaded_path:
+                continue
+
+            relative_path = os.path.relpath(downloaded_path, DOWNLOAD_DIR)
+            file_url = f"/downloads/{relative_path.replace(os.sep, '/')}"
+            
+            object_annotation = annotations.get(best_uid, {})
+            scene_objects.append({
+                "uid": best_uid,
+                "name": object_annotation.get('name', ''),
+                "fileURL": file_url,
+                "position": item["position"],
+                "rotation": item["rotation"],
+                "type": item["keyword"],
+                "rating": best_rating,
+                "explanation": best_explanation
+            })
+
+        return {
             "theme": theme,
             "objects": scene_objects
-        })
+        }
 
     except Exception as e:
         logger.error(f"Error initializing scene: {e}")
@@ -1,16 +1,17 @@
 # backend/app.py
 
 import os
+import orjson
+import asyncio
 import shutil
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
 from fastapi.staticfiles import StaticFiles
 from dotenv import load_dotenv
 import openai
 import pandas as pd
 import objaverse.xl as oxl
-from typing import Optional, List
+from typing import Any, Optional, List, Dict
 import logging
 import traceback
 
@@ -45,18 +46,28 @@ app.mount("/downloads", StaticFiles(directory=DOWNLOAD_DIR), name="downloads")
 
 # Global variable to store annotations
 annotations_df = pd.DataFrame()
+# 'obj' rows of annotations_df with precomputed lowercase search columns
+obj_df = pd.DataFrame()
 
 # Load annotations on startup
 @app.on_event("startup")
 def setup():
-    global annotations_df
+    global annotations_df, obj_df
     try:
         logger.info("Loading Objaverse annotations...")
         annotations_df = oxl.get_alignment_annotations(download_dir=DOWNLOAD_DIR)
         logger.info(f"Loaded {len(annotations_df)} annotations.")
+
+        # Lowercase the searchable columns once instead of on every request
+        annotations_df['metadata_lc'] = annotations_df['metadata'].astype(str).str.lower()
+        annotations_df['fileIdentifier_lc'] = annotations_df['fileIdentifier'].str.lower()
+        annotations_df['fileType_lc'] = annotations_df['fileType'].str.lower()
+        obj_df = annotations_df[annotations_df['fileType_lc'] == 'obj']
+        logger.info(f"Found {len(obj_df)} 'obj' annotations.")
     except Exception as e:
         logger.error(f"Error loading annotations: {e}")
         annotations_df = pd.DataFrame()  # Empty DataFrame in case of failure
+        obj_df = pd.DataFrame()
 
 
 def find_relevant_object_keyword(prompt: str) -> Optional[pd.Series]:
@@ -73,25 +84,13 @@ def find_relevant_object_keyword(prompt: str) -> Optional[pd.Series]:
     # Lowercase the prompt (assuming it's a single word)
     keyword = prompt.lower()
     
-    # Search in 'fileIdentifier' first
-    annotations_df['metadata_str'] = annotations_df['metadata'].astype(str).str.lower()
-    mask_file_identifier = (
-        (annotations_df['fileType'].str.lower() == 'obj') &  # Filter for 'obj' fileType
-        annotations_df['metadata_str'].str.contains(keyword, na=False)
-    )
-
-    # Filter the DataFrame based on 'fileIdentifier'
-    filtered = annotations_df[mask_file_identifier]
+    # Search in 'metadata' first (plain substring match, no regex)
+    filtered = obj_df[obj_df['metadata_lc'].str.contains(keyword, regex=False, na=False)]
 
-    # If no results found in 'fileIdentifier', search in 'metadata'
+    # If no results found in 'metadata', search in 'fileIdentifier'
     if filtered.empty:
-        print("no metadata found")
-        # Assuming 'metadata' is a dictionary stored as a string
-        mask_metadata = (
-            (annotations_df['fileType'].str.lower() == 'obj') & 
-            annotations_df['fileIdentifier'].str.contains(keyword, na=False)
-        )
-        filtered = annotations_df[mask_metadata]
+        logger.debug("No metadata match for keyword '%s'", keyword)
+        filtered = obj_df[obj_df['fileIdentifier_lc'].str.contains(keyword, regex=False, na=False)]
 
     # If results found, return the first match
     if not filtered.empty:
@@ -101,9 +100,8 @@ def find_relevant_object_keyword(prompt: str) -> Optional[pd.Series]:
     else:
         # If no matches, select a random 'obj' object
         logger.warning(f"No relevant 'obj' objects found for keyword '{keyword}'. Selecting a random 'obj' object.")
-        random_objs = annotations_df[annotations_df['fileType'].str.lower() == 'obj']
-        if not random_objs.empty:
-            selected_obj = random_objs.sample(n=1).iloc[0]
+        if not obj_df.empty:
+            selected_obj = obj_df.sample(n=1).iloc[0]
             logger.info(f"Selected random object: {selected_obj['fileIdentifier']}")
             return selected_obj
         else:
@@ -133,25 +131,27 @@ def download_object(obj: pd.Series) -> Optional[str]:
         return None
 
 @app.post("/generate_scene")
-async def generate_scene(request: Request):
+async def generate_scene(request: Request) -> Dict[str, Any]:
     """
     Endpoint to generate a 3D scene based on a user prompt.
     Expects a JSON payload with a 'prompt' field.
     """
     try:
-        data = await request.json()
+        try:
+            data = orjson.loads(await request.body())
+        except orjson.JSONDecodeError:
+            raise HTTPException(status_code=400, detail="Invalid JSON body.")
         prompt = data.get("prompt", "").strip()
         if not prompt:
             raise HTTPException(status_code=400, detail="Prompt is required.")
 
         # Step 1: Perform keyword-based search
-        selected_obj = find_relevant_object_keyword(prompt)
-        print(selected_obj)
+        selected_obj = await asyncio.to_thread(find_relevant_object_keyword, prompt)
         if selected_obj is None:
             raise HTTPException(status_code=404, detail="No 'obj' type objects available to generate the scene.")
 
         # Step 2: Attempt to download the selected object
-        downloaded_path = download_object(selected_obj)
+        downloaded_path = await asyncio.to_thread(download_object, selected_obj)
         if not downloaded_path:
             raise HTTPException(status_code=500, detail="Failed to download the selected object.")
 
@@ -168,7 +168,7 @@ async def generate_scene(request: Request):
             "metadata": selected_obj['metadata']
         }
 
-        return JSONResponse(content=response)
+        return response
 
     except HTTPException as he:
         logger.error(f"HTTPException: {he.detail}")
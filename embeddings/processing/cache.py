@@ -0,0 +1,65 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from typing import Awaitable, Callable, List, Optional
+
+import numpy as np
+
+# Keep the cache next to stories_smaller_chunks.json in the parent directory
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+cache_path = os.path.join(parent_dir, 'api_cache.sqlite')
+
+# One connection shared by the worker threads, guarded by a lock
+_connection = sqlite3.connect(cache_path, check_same_thread=False)
+_connection.execute("CREATE TABLE IF NOT EXISTS embeddings (hash TEXT PRIMARY KEY, vector BLOB)")
+_connection.execute("CREATE TABLE IF NOT EXISTS responses (hash TEXT PRIMARY KEY, response TEXT)")
+_connection.commit()
+_lock = threading.Lock()
+
+def content_hash(*parts: str) -> str:
+    """SHA-256 of the given strings, used as the cache key"""
+    return hashlib.sha256("\x00".join(parts).encode('utf-8')).hexdigest()
+
+def get_embedding(key: str) -> Optional[List[float]]:
+    """Return the cached embedding for a key, or None on a miss"""
+    with _lock:
+        row = _connection.execute("SELECT vector FROM embeddings WHERE hash = ?", (key,)).fetchone()
+    if row is None:
+        return None
+    return np.frombuffer(row[0], dtype=np.float32).tolist()
+
+def put_embedding(key: str, vector: List[float]) -> None:
+    """Store an embedding as raw float32 bytes"""
+    blob = np.asarray(vector, dtype=np.float32).tobytes()
+    with _lock:
+        _connection.execute("INSERT OR REPLACE INTO embeddings VALUES (?, ?)", (key, blob))
+        _connection.commit()
+
+def get_response(prompt: str, model_name: str) -> Optional[str]:
+    """Return the cached response for a prompt, or None on a miss"""
+    with _lock:
+        row = _connection.execute(
+            "SELECT response FROM responses WHERE hash = ?", (content_hash(prompt, model_name),)
+        ).fetchone()
+    return None if row is None else row[0]
+
+async def cached_response(prompt: str, model_name: str, generate: Callable[[str], Awaitable[str]],
+                          validate: Optional[Callable[[str], bool]] = None) -> str:
+    """
+    Return the cached response for a prompt, awaiting generate only on a miss.
+    When validate is given, only responses it accepts are cached; a rejected
+    response raises ValueError so the prompt is asked again on the next run.
+    """
+    response = get_response(prompt, model_name)
+    # Entries saved before validation existed may be unusable, so ask again for those
+    if response is not None and (validate is None or validate(response)):
+        return response
+
+    response = await generate(prompt)
+    if validate is not None and not validate(response):
+        raise ValueError(f"Unusable response, not cached: {response!r}")
+    with _lock:
+        _connection.execute("INSERT OR REPLACE INTO responses VALUES (?, ?)", (content_hash(prompt, model_name), response))
+        _connection.commit()
+    return response
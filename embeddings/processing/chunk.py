@@ -1,12 +1,11 @@
 # Recursive Chunking
 # First process step
-import json
-import os
+import orjson
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 
-# Get the path to stories.json in parent directory
-parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-stories_path = os.path.join(parent_dir, 'stories_smaller_chunks.json')
+from progress import save_stories, stories_path
 
 # Initialize text splitter with smarter separators
 text_splitter = RecursiveCharacterTextSplitter(
@@ -19,30 +18,36 @@ text_splitter = RecursiveCharacterTextSplitter(
     keep_separator=True  # Keep the separator at the end of each chunk
 )
 
-# Read the stories file
-with open(stories_path, 'r', encoding='utf-8') as file:
-    data = json.load(file)
+def split_story(content: str) -> List[str]:
+    """Split a story's content into chunk strings"""
+    chunks = text_splitter.create_documents([content])
+    return [chunk.page_content.strip() for chunk in chunks]  # Strip any extra whitespace
 
-# Process each story in the stories array
-for story in data['stories']:
-    if 'content' in story:
-        # Split the content into chunks
-        chunks = text_splitter.create_documents([story['content']])
+def main():
+    # Read the stories file
+    with open(stories_path, 'rb') as file:
+        data = orjson.loads(file.read())
+
+    # Split the stories in parallel, one worker process per CPU
+    stories = [story for story in data['stories'] if 'content' in story]
+    with ProcessPoolExecutor() as executor:
+        results = executor.map(split_story, [story['content'] for story in stories], chunksize=8)
         
         # Convert chunks to the desired format
-        story['chunks'] = [
-            {'content': chunk.page_content.strip()}  # Strip any extra whitespace
-            for chunk in chunks
-        ]
-
-# Save the updated stories back to the file
-with open(stories_path, 'w', encoding='utf-8') as file:
-    json.dump(data, file, indent=2)
-
-# Optional: Print first few chunks of first story to check the splitting
-if len(data['stories']) > 0 and 'chunks' in data['stories'][0]:
-    print("\nExample chunks from first story:")
-    for i, chunk in enumerate(data['stories'][0]['chunks'][:3]):
-        print(f"\nChunk {i + 1}:")
-        print(chunk['content'])
-        print("-" * 80)
\ No newline at end of file
+        for story, chunks in zip(stories, results):
+            story['chunks'] = [{'content': chunk} for chunk in chunks]
+
+    # Save the updated stories back to the file; this also clears the progress
+    # log, whose results belong to the old chunks
+    save_stories(data)
+
+    # Optional: Print first few chunks of first story to check the splitting
+    if len(data['stories']) > 0 and 'chunks' in data['stories'][0]:
+        print("\nExample chunks from first story:")
+        for i, chunk in enumerate(data['stories'][0]['chunks'][:3]):
+            print(f"\nChunk {i + 1}:")
+            print(chunk['content'])
+            print("-" * 80)
+
+if __name__ == "__main__":
+    main()
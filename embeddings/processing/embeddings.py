@@ -1,75 +1,106 @@
-import json
 import os
 import google.generativeai as genai
-from typing import Dict, List
+from google.generativeai.client import get_default_generative_client
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List
 
-# Get the path to stories.json in parent directory
-parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-stories_path = os.path.join(parent_dir, 'stories_smaller_chunks.json')
+import cache
+from progress import MIN_CHARS, load_stories, record_result, save_stories
 
 # Configure Gemini
 api_key = os.getenv("GOOGLE_API_KEY")
 if not api_key:
     raise ValueError("Google API key not found in environment variables")
 
-genai.configure(api_key=api_key)
+# Every batch request shares the default client's single long-lived gRPC channel
+genai.configure(api_key=api_key, transport='grpc')
 
-def get_embedding(content: str, title: str = "Embedding") -> List[float]:
-    """Get embedding for a piece of content"""
-    result = genai.embed_content(
-        model="models/text-embedding-004",
-        content=content,
-        task_type="retrieval_document",
-        title=title
-    )
-    return result['embedding']
+EMBEDDING_MODEL = "models/text-embedding-004"
+# Number of chunks embedded per batchEmbedContents request (API maximum)
+BATCH_SIZE = 100
+# Number of batch requests in flight at once
+MAX_WORKERS = 8
+
+def get_embeddings_batch(contents: List[str], titles: List[str]) -> List[List[float]]:
+    """Get embeddings for several pieces of content, requesting only the ones not already cached"""
+    keys = [cache.content_hash(content, EMBEDDING_MODEL, "RETRIEVAL_DOCUMENT") for content in contents]
+    embeddings = [cache.get_embedding(key) for key in keys]
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    if not missing:
+        return embeddings
 
-def save_progress(data: Dict) -> None:
-    """Save the current state to the JSON file"""
-    with open(stories_path, 'w', encoding='utf-8') as file:
-        json.dump(data, file, indent=2)
+    requests = [
+        genai.protos.EmbedContentRequest(
+            model=EMBEDDING_MODEL,
+            content=genai.protos.Content(parts=[genai.protos.Part(text=contents[i])]),
+            task_type=genai.protos.TaskType.RETRIEVAL_DOCUMENT,
+            title=titles[i]
+        )
+        for i in missing
+    ]
+    response = get_default_generative_client().batch_embed_contents(
+        genai.protos.BatchEmbedContentsRequest(model=EMBEDDING_MODEL, requests=requests)
+    )
+    for i, embedding in zip(missing, response.embeddings):
+        embeddings[i] = list(embedding.values)
+        cache.put_embedding(keys[i], embeddings[i])
+    return embeddings
 
 def main():
-    # Load the stories
-    with open(stories_path, 'r', encoding='utf-8') as file:
-        data = json.load(file)
+    # Load the stories, including results logged by an interrupted run
+    data = load_stories()
 
-    # Process each story
+    # Embeddings already generated, by content, so duplicate chunks can copy them
+    known = {
+        chunk['content']: chunk['embedding']
+        for story in data['stories']
+        for chunk in story.get('chunks', [])
+        if 'embedding' in chunk
+    }
+
+    # Collect every chunk that still needs an embedding, grouped by content
+    # so duplicate chunks share one embedding
+    pending = {}
     for story_index, story in enumerate(data['stories']):
-        print(f"\nProcessing story {story_index + 1}/{len(data['stories'])}")
-        
-        # # Generate embedding for main content if not already done
-        # if 'content' in story and 'embedding' not in story:
-        #     try:
-        #         print("Generating embedding for main content...")
-        #         story['embedding'] = get_embedding(
-        #             story['content'],
-        #             f"Story {story_index + 1} Main Content"
-        #         )
-        #         save_progress(data)
-        #         print("Main content embedding generated and saved")
-        #     except Exception as e:
-        #         print(f"Error generating main content embedding: {str(e)}")
-        #         continue
+        for chunk_index, chunk in enumerate(story.get('chunks', [])):
+            if 'embedding' in chunk:
+                continue
+            # Too short to be worth embedding
+            if len(chunk['content'].strip()) < MIN_CHARS:
+                continue
+            if chunk['content'] in known:
+                chunk['embedding'] = known[chunk['content']]
+                record_result(story_index, chunk_index, ['embedding'], chunk['embedding'])
+                continue
+            pending.setdefault(chunk['content'], []).append((story_index, chunk_index))
+    contents = list(pending)
+    print(f"\n{len(contents)} unique chunks need embeddings")
+
+    # Embed the pending chunks in concurrent batches, logging each result as it arrives
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = {}
+        for start in range(0, len(contents), BATCH_SIZE):
+            batch = contents[start:start + BATCH_SIZE]
+            future = executor.submit(
+                get_embeddings_batch,
+                batch,
+                [f"Story {pending[content][0][0] + 1} Chunk {pending[content][0][1] + 1}" for content in batch]
+            )
+            futures[future] = (start, batch)
 
-        # Process each chunk
-        if 'chunks' in story:
-            for chunk_index, chunk in enumerate(story['chunks']):
-                if 'embedding' not in chunk:
-                    try:
-                        print(f"Generating embedding for chunk {chunk_index + 1}/{len(story['chunks'])}...")
-                        chunk['embedding'] = get_embedding(
-                            chunk['content'],
-                            f"Story {story_index + 1} Chunk {chunk_index + 1}"
-                        )
-                        save_progress(data)
-                        print(f"Chunk {chunk_index + 1} embedding generated and saved")
-                    except Exception as e:
-                        print(f"Error processing chunk {chunk_index + 1}: {str(e)}")
-                        continue
-                else:
-                    print(f"Chunk {chunk_index + 1} already has embedding, skipping...")
+        for future in as_completed(futures):
+            start, batch = futures[future]
+            try:
+                for content, embedding in zip(batch, future.result()):
+                    for story_index, chunk_index in pending[content]:
+                        data['stories'][story_index]['chunks'][chunk_index]['embedding'] = embedding
+                        record_result(story_index, chunk_index, ['embedding'], embedding)
+                print(f"Embeddings for chunks {start + 1}-{start + len(batch)}/{len(contents)} generated and logged")
+            except Exception as e:
+                print(f"Error processing chunks {start + 1}-{start + len(batch)}: {str(e)}")
+                continue
 
+    save_stories(data)
     print("\nAll embeddings generated!")
 
 if __name__ == "__main__":
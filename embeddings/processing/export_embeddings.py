@@ -0,0 +1,40 @@
+import os
+import numpy as np
+import pandas as pd
+
+from progress import load_stories, parent_dir
+
+# Compact copies of the stories file read by the visualization apps
+embeddings_path = os.path.join(parent_dir, 'embeddings.npy')
+chunks_path = os.path.join(parent_dir, 'chunks.parquet')
+
+def main():
+    # Load the stories, including results logged by an interrupted run
+    data = load_stories()
+
+    rows = []
+    embeddings = []
+    for story_index, story in enumerate(data['stories']):
+        for chunk_index, chunk in enumerate(story.get('chunks', [])):
+            if 'embedding' not in chunk:
+                continue
+
+            row = {
+                'story_index': story_index,
+                'chunk_index': chunk_index,
+                'content': chunk['content'],
+                'timing': chunk.get('timing', 'unknown'),
+            }
+            for tactic, score in chunk.get('manipulation_tactics', {}).items():
+                row[f'manipulation_tactics.{tactic}'] = score
+
+            rows.append(row)
+            embeddings.append(chunk['embedding'])
+
+    # Row i of chunks.parquet describes row i of embeddings.npy
+    np.save(embeddings_path, np.asarray(embeddings, dtype=np.float32))
+    pd.DataFrame(rows).to_parquet(chunks_path, index=False)
+    print(f"Exported {len(rows)} chunk embeddings to {embeddings_path} and {chunks_path}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+import os
+from typing import Any, Dict, List
+
+import orjson
+
+# Get the path to stories.json in parent directory
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+stories_path = os.path.join(parent_dir, 'stories_smaller_chunks.json')
+# Append-only log of results that have not been written back into stories_path yet
+progress_path = os.path.join(parent_dir, 'stories_smaller_chunks.progress.jsonl')
+
+# Chunks shorter than this (ignoring whitespace) are not worth an API call
+MIN_CHARS = 32
+
+def load_stories() -> Dict:
+    """Load the stories and replay any results logged since the last full save"""
+    with open(stories_path, 'rb') as file:
+        data = orjson.loads(file.read())
+
+    if not os.path.exists(progress_path):
+        return data
+
+    replayed = 0
+    with open(progress_path, 'rb') as file:
+        for line in file:
+            try:
+                record = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                # An interrupted run can leave the last line half written
+                continue
+            target = data['stories'][record['story']]['chunks'][record['chunk']]
+            *parents, field = record['keys']
+            for key in parents:
+                target = target.setdefault(key, {})
+            target[field] = record['value']
+            replayed += 1
+    print(f"Replayed {replayed} results from {progress_path}")
+    return data
+
+def record_result(story_index: int, chunk_index: int, keys: List[str], value: Any) -> None:
+    """Append a single chunk result to the progress log"""
+    record = {'story': story_index, 'chunk': chunk_index, 'keys': keys, 'value': value}
+    with open(progress_path, 'ab') as file:
+        file.write(orjson.dumps(record) + b"\n")
+
+def save_stories(data: Dict) -> None:
+    """Write the full stories file and clear the progress log it now contains"""
+    tmp_path = stories_path + '.tmp'
+    with open(tmp_path, 'wb') as file:
+        file.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+    os.replace(tmp_path, stories_path)
+    if os.path.exists(progress_path):
+        os.remove(progress_path)
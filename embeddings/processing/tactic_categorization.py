@@ -1,12 +1,12 @@
-import json
+import asyncio
 import os
+import re
+import orjson
 import google.generativeai as genai
-from typing import Dict, List
-from ratelimit import limits, sleep_and_retry
+from typing import Dict, List, Optional
 
-# Get the path to stories.json in parent directory
-parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-stories_path = os.path.join(parent_dir, 'stories_smaller_chunks.json')
+import cache
+from progress import MIN_CHARS, load_stories, record_result, save_stories
 
 # Configure Gemini
 api_key = os.getenv("GOOGLE_API_KEY")
@@ -16,6 +16,9 @@ if not api_key:
 genai.configure(api_key=api_key)
 model = genai.GenerativeModel("gemini-1.5-pro", system_instruction="You are an expert in relationships, psychology and manipulation techniques. You're putting together educational materials to help people identify these techniques in their own lives.")
 
+# Number of Gemini requests in flight at once
+MAX_CONCURRENT_REQUESTS = 8
+
 TACTICS = {
     "gaslighting": {
         "examples": [
@@ -59,91 +62,126 @@ TACTICS = {
     }
 }
 
-# Rate limiting decorator: 15 calls per minute
-# @sleep_and_retry
-# @limits(calls=15, period=60)
-def analyze_single_tactic(chunk_content: str, tactic: str, examples: List[str]) -> int:
-    examples_text = "\n".join(f"- {example}" for example in examples)
+request_slots = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+async def generate(prompt: str) -> str:
+    async with request_slots:
+        response = await model.generate_content_async(prompt, generation_config={"response_mime_type": "application/json"})
+    return response.text
+
+def parse_ratings(response: str) -> Optional[Dict[str, int]]:
+    """Read an integer rating for every tactic from a reply, or None if any is missing or invalid"""
+    try:
+        ratings = orjson.loads(response)
+    except orjson.JSONDecodeError:
+        # Pick the "tactic": rating pairs out of malformed output
+        ratings = dict(re.findall(r'"(\w+)"\s*:\s*(\d)', response))
+    if not isinstance(ratings, dict):
+        return None
+    try:
+        return {tactic: int(ratings[tactic]) for tactic in TACTICS}
+    except (KeyError, TypeError, ValueError):
+        return None
+
+async def analyze_all_tactics(chunk_content: str) -> Dict[str, int]:
+    """Rate every tactic for a chunk in a single request"""
+    tactics_text = "\n\n".join(
+        f"{tactic}:\n" + "\n".join(f"- {example}" for example in tactic_data['examples'])
+        for tactic, tactic_data in TACTICS.items()
+    )
+    response_format = ", ".join(f'"{tactic}": 0' for tactic in TACTICS)
     
-    prompt = f"""Analyze this story of an abusive relationship for signs of {tactic}. 
+    prompt = f"""Analyze this story of an abusive relationship for signs of the following manipulation tactics.
 
-Define {tactic} based on the following examples:
-{examples_text}
+Define each tactic based on the following examples:
+{tactics_text}
     
-Rate from 0-3 how strongly this manipulation tactic appears (0 = not present, 1 = slightly present, 2 = moderately present, 3 = strongly present). This is for educational purposes.
+For each tactic, rate from 0-3 how strongly it appears (0 = not present, 1 = slightly present, 2 = moderately present, 3 = strongly present). This is for educational purposes.
 
-Assume most snippets will not have this tactic present, since these are only parts of a larger story. Only rate 2 or 3 if there is strong evidence of this particular tactic in the text that would help another person identify it in the future.
+Assume most snippets will not have these tactics present, since these are only parts of a larger story. Only rate 2 or 3 if there is strong evidence of that particular tactic in the text that would help another person identify it in the future.
 
 Story to analyze:
 {chunk_content}
 
-Respond with ONLY a single number (0, 1, 2, or 3)."""
-
-    response = model.generate_content(prompt)
-    return int(response.text.strip())
+Respond with ONLY a JSON object mapping each tactic to its rating, like {{{response_format}}}."""
+
+    # Only replies that rate every tactic are cached, so a partial one is asked again
+    response = await cache.cached_response(
+        prompt, model.model_name, generate, validate=lambda response: parse_ratings(response) is not None
+    )
+    return parse_ratings(response)
+
+async def analyze_jobs(jobs: Dict[str, List]) -> None:
+    """Analyze the unique chunks concurrently, writing results back as they complete"""
+    async def analyze(content: str, targets: List) -> None:
+        try:
+            ratings = await analyze_all_tactics(content)
+        except Exception as e:
+            for story_index, chunk_index, _ in targets:
+                print(f"Error processing story {story_index + 1} chunk {chunk_index + 1}: {str(e)}")
+            return
+
+        # Save the ratings, keeping any that were already there
+        for story_index, chunk_index, chunk in targets:
+            for tactic, rating in ratings.items():
+                if tactic not in chunk['manipulation_tactics']:
+                    chunk['manipulation_tactics'][tactic] = rating
+                    record_result(story_index, chunk_index, ['manipulation_tactics', tactic], rating)
+            print(f"Story {story_index + 1} chunk {chunk_index + 1} ratings: {ratings}")
+
+    await asyncio.gather(*(analyze(content, targets) for content, targets in jobs.items()))
 
-def save_progress(data: Dict) -> None:
-    """Save the current state to the JSON file"""
-    with open(stories_path, 'w', encoding='utf-8') as file:
-        json.dump(data, file, indent=2)
+def main():
+    # Load the stories, including results logged by an interrupted run
+    data = load_stories()
+
+    # Complete ratings already made, by content, so duplicate chunks can copy them
+    known = {
+        chunk['content']: chunk['manipulation_tactics']
+        for story in data['stories']
+        for chunk in story.get('chunks', [])
+        if all(tactic in chunk.get('manipulation_tactics', {}) for tactic in TACTICS)
+    }
 
-def analyze_tactic_for_all_chunks(tactic_name: str, data: Dict) -> Dict:
-    print(f"\nAnalyzing {tactic_name}...")
-    
-    tactic_data = TACTICS[tactic_name]
-    
-    # Process each story
+    # Collect the chunks missing a rating for any tactic, grouped by content
+    # so duplicate chunks share one request
+    jobs = {}
     for story_index, story in enumerate(data['stories']):
         if 'content' not in story or 'chunks' not in story:
             continue
 
-        print(f"\nProcessing story {story_index + 1}/{len(data['stories'])}")
-        
-        # Process each chunk
         for chunk_index, chunk in enumerate(story['chunks']):
             # Initialize manipulation_tactics if it doesn't exist
             if 'manipulation_tactics' not in chunk:
                 chunk['manipulation_tactics'] = {}
                 
-            # Skip if this tactic has already been analyzed for this chunk
-            if tactic_name in chunk['manipulation_tactics']:
-                print(f"Chunk {chunk_index + 1} already analyzed for {tactic_name}, skipping...")
+            # Skip if every tactic has already been analyzed for this chunk
+            if all(tactic in chunk['manipulation_tactics'] for tactic in TACTICS):
+                print(f"Story {story_index + 1} chunk {chunk_index + 1} already analyzed, skipping...")
                 continue
 
-            try:
-                print(f"Analyzing chunk {chunk_index + 1}/{len(story['chunks'])} for {tactic_name}...")
-                rating = analyze_single_tactic(
-                    chunk['content'], 
-                    tactic_name, 
-                    tactic_data['examples']
-                )
-                
-                # Save the rating
-                chunk['manipulation_tactics'][tactic_name] = rating
-                
-                # Save progress after each chunk
-                save_progress(data)
-                print(f"Chunk {chunk_index + 1} {tactic_name} rating: {rating}")
-                
-            except Exception as e:
-                print(f"Error processing chunk {chunk_index + 1}: {str(e)}")
-                # Save progress even if there's an error
-                save_progress(data)
+            # Too short to show any tactic, so rate it 0 without asking
+            if len(chunk['content'].strip()) < MIN_CHARS:
+                for tactic in TACTICS:
+                    if tactic not in chunk['manipulation_tactics']:
+                        chunk['manipulation_tactics'][tactic] = 0
+                        record_result(story_index, chunk_index, ['manipulation_tactics', tactic], 0)
                 continue
-    
-    return data
 
-def main():
-    # Load the stories
-    with open(stories_path, 'r', encoding='utf-8') as file:
-        data = json.load(file)
-    
-    # Process each tactic sequentially
-    for tactic_name in TACTICS.keys():
-        print(f"\nStarting analysis for {tactic_name}...")
-        data = analyze_tactic_for_all_chunks(tactic_name, data)
-        print(f"Completed analysis for {tactic_name}")
-    
+            if chunk['content'] in known:
+                for tactic in TACTICS:
+                    if tactic not in chunk['manipulation_tactics']:
+                        chunk['manipulation_tactics'][tactic] = known[chunk['content']][tactic]
+                        record_result(story_index, chunk_index, ['manipulation_tactics', tactic], chunk['manipulation_tactics'][tactic])
+                print(f"Story {story_index + 1} chunk {chunk_index + 1} copied ratings from a duplicate chunk")
+                continue
+
+            jobs.setdefault(chunk['content'], []).append((story_index, chunk_index, chunk))
+
+    print(f"\nAnalyzing {len(jobs)} unique chunks...")
+
+    asyncio.run(analyze_jobs(jobs))
+    save_stories(data)
     print("\nAnalysis complete for all tactics!")
 
 if __name__ == "__main__":
@@ -1,13 +1,13 @@
-import json
+import asyncio
+import datetime
 import os
 import time
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple
 import google.generativeai as genai
-from ratelimit import limits, sleep_and_retry
+from aiolimiter import AsyncLimiter
 
-# Get the path to stories.json in parent directory
-parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-stories_path = os.path.join(parent_dir, 'stories_smaller_chunks.json')
+import cache
+from progress import MIN_CHARS, load_stories, record_result, save_stories
 
 # Configure Gemini
 api_key = os.getenv("GOOGLE_API_KEY")
@@ -17,11 +17,31 @@ if not api_key:
 genai.configure(api_key=api_key)
 model = genai.GenerativeModel("gemini-1.5-flash")
 
-# Rate limiting decorator: 15 calls per minute
-@sleep_and_retry
-@limits(calls=15, period=60)
-def analyze_chunk(chunk_content: str, full_story: str) -> str:
-    prompt = f"""Given the following section of text from a domestic abuse story, determine at what phase of the abusive relationship this chunk takes place. The possible phases are:
+# Number of Gemini requests in flight at once (still bounded by the rate limit)
+MAX_CONCURRENT_REQUESTS = 8
+
+# Gemini only caches contexts of at least this many tokens, and only for
+# explicitly versioned models
+MIN_CACHED_TOKENS = 32768
+CACHE_MODEL = "models/gemini-1.5-flash-002"
+
+# Rate limiting: 15 calls per minute, free to burst at the start of each window
+limiter = AsyncLimiter(15, 60)
+request_slots = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+async def generate(prompt: str, generative_model: genai.GenerativeModel = model) -> str:
+    async with request_slots, limiter:
+        response = await generative_model.generate_content_async(prompt)
+    return response.text
+
+def build_prompt(chunk_content: str, full_story: Optional[str]) -> str:
+    """Build the timeline prompt; pass full_story=None when the story is in a cached context"""
+    story_text = f"""Full story for context:
+{full_story}
+
+""" if full_story is not None else ""
+
+    return f"""Given the following section of text from a domestic abuse story, determine at what phase of the abusive relationship this chunk takes place. The possible phases are:
 - "beginning": Early stages of the relationship
 - "middle": During the ongoing abusive relationship
 - "leaving": When the victim is in the process of leaving or deciding to leave
@@ -30,54 +50,147 @@ def analyze_chunk(chunk_content: str, full_story: str) -> str:
 The goal is to categorize types of abusive tactics to help educate others on the tactics of abusers.
 Analyze this specific section in the context of the full story.
 
-Full story for context:
-{full_story}
-
-Specific section to analyze and label:
+{story_text}Specific section to analyze and label:
 {chunk_content}
 
 Reply with ONLY ONE WORD - either "beginning", "middle", "leaving", or "after"."""
 
-    response = model.generate_content(prompt)
-    return response.text.strip().lower()
+def cacheable(full_story: str) -> bool:
+    """Whether a story is long enough for Gemini's context cache"""
+    # Roughly four characters per token
+    return len(full_story) // 4 >= MIN_CACHED_TOKENS
+
+def cache_story(full_story: str) -> Optional[genai.caching.CachedContent]:
+    """Put a story in Gemini's context cache, or return None if it is too small or caching fails"""
+    if not cacheable(full_story):
+        return None
+    try:
+        return genai.caching.CachedContent.create(
+            model=CACHE_MODEL,
+            contents=[f"Full story for context:\n{full_story}"],
+            ttl=datetime.timedelta(hours=1)
+        )
+    except Exception as e:
+        print(f"Could not cache story, sending it with each chunk instead: {str(e)}")
+        return None
+
+async def analyze_chunk(chunk_content: str, full_story: str, story_model: Optional[genai.GenerativeModel] = None) -> str:
+    # Responses are cached under the full prompt either way, so both paths share results
+    prompt = build_prompt(chunk_content, full_story)
+    if story_model is None:
+        send = generate
+    else:
+        # The story is already in the cached context, so only send the chunk
+        async def send(_: str) -> str:
+            return await generate(build_prompt(chunk_content, None), story_model)
+
+    # Cache hits skip both the API call and the rate limiter
+    response = await cache.cached_response(prompt, model.model_name, send)
+    return response.strip().lower()
 
-def save_progress(data: Dict) -> None:
-    """Save the current state to the JSON file"""
-    with open(stories_path, 'w', encoding='utf-8') as file:
-        json.dump(data, file, indent=2)
+async def analyze_jobs(jobs: Dict[Tuple[str, str], List]) -> None:
+    """Analyze the unique chunks concurrently, writing results back as they complete"""
+    async def analyze(chunk_content: str, full_story: str, targets: List, story_model: Optional[genai.GenerativeModel]) -> None:
+        try:
+            timing = await analyze_chunk(chunk_content, full_story, story_model)
+        except Exception as e:
+            for story_index, chunk_index, _ in targets:
+                print(f"Error processing story {story_index + 1} chunk {chunk_index + 1}: {str(e)}")
+            return
+
+        for story_index, chunk_index, chunk in targets:
+            chunk['timing'] = timing
+            record_result(story_index, chunk_index, ['timing'], chunk['timing'])
+            print(f"Story {story_index + 1} chunk {chunk_index + 1} timing: {chunk['timing']}")
+
+    async def analyze_story(full_story: str, chunk_jobs: Dict[str, List],
+                            story_cache: Optional[genai.caching.CachedContent] = None) -> None:
+        story_model = genai.GenerativeModel.from_cached_content(story_cache) if story_cache is not None else None
+        try:
+            await asyncio.gather(*(
+                analyze(chunk_content, full_story, targets, story_model)
+                for chunk_content, targets in chunk_jobs.items()
+            ))
+        finally:
+            # Delete the cache as soon as the story is done to stop storage charges
+            if story_cache is not None:
+                await asyncio.to_thread(story_cache.delete)
+
+    async def analyze_cached_stories(stories: List[Tuple[str, Dict[str, List]]]) -> None:
+        # One story at a time, so only one context cache is billed at once and
+        # none expires while its chunks wait behind the rate limiter
+        for full_story, chunk_jobs in stories:
+            story_cache = await asyncio.to_thread(cache_story, full_story)
+            await analyze_story(full_story, chunk_jobs, story_cache)
+
+    jobs_by_story = {}
+    for (chunk_content, full_story), targets in jobs.items():
+        jobs_by_story.setdefault(full_story, {})[chunk_content] = targets
+
+    # Only pay for a context cache when some chunk of a long story actually
+    # needs a request
+    cached_stories = []
+    plain_stories = []
+    for full_story, chunk_jobs in jobs_by_story.items():
+        if cacheable(full_story) and any(
+            cache.get_response(build_prompt(chunk_content, full_story), model.model_name) is None
+            for chunk_content in chunk_jobs
+        ):
+            cached_stories.append((full_story, chunk_jobs))
+        else:
+            plain_stories.append((full_story, chunk_jobs))
+
+    # Finish the cached stories before queueing the rest behind the shared rate
+    # limiter, so their requests never wait out a cache's TTL
+    await analyze_cached_stories(cached_stories)
+    await asyncio.gather(*(
+        analyze_story(full_story, chunk_jobs)
+        for full_story, chunk_jobs in plain_stories
+    ))
 
 def main():
-    # Load the stories
-    with open(stories_path, 'r', encoding='utf-8') as file:
-        data = json.load(file)
+    # Load the stories, including results logged by an interrupted run
+    data = load_stories()
 
-    # Process each story
+    # Timings already assigned, by chunk and story, so duplicate chunks can copy them
+    known = {
+        (chunk['content'], story['content']): chunk['timing']
+        for story in data['stories'] if 'content' in story
+        for chunk in story.get('chunks', [])
+        if 'timing' in chunk
+    }
+
+    # Collect the chunks that have not been analyzed yet, grouped by content
+    # and story so duplicate chunks share one request
+    jobs = {}
     for story_index, story in enumerate(data['stories']):
         if 'content' not in story or 'chunks' not in story:
             continue
 
-        print(f"\nProcessing story {story_index + 1}/{len(data['stories'])}")
-        
-        # Process each chunk
         for chunk_index, chunk in enumerate(story['chunks']):
             # Skip if already analyzed
             if 'timing' in chunk:
-                print(f"Chunk {chunk_index + 1} already analyzed, skipping...")
+                print(f"Story {story_index + 1} chunk {chunk_index + 1} already analyzed, skipping...")
+                continue
+
+            # Too short to place in the timeline without asking
+            if len(chunk['content'].strip()) < MIN_CHARS:
+                chunk['timing'] = 'unknown'
+                record_result(story_index, chunk_index, ['timing'], chunk['timing'])
                 continue
 
-            try:
-                print(f"Analyzing chunk {chunk_index + 1}/{len(story['chunks'])}...")
-                chunk['timing'] = analyze_chunk(chunk['content'], story['content'])
-                
-                # Save progress after each chunk
-                save_progress(data)
-                print(f"Chunk {chunk_index + 1} timing: {chunk['timing']}")
-                
-            except Exception as e:
-                print(f"Error processing chunk {chunk_index + 1}: {str(e)}")
-                # Save progress even if there's an error
-                save_progress(data)
+            if (chunk['content'], story['content']) in known:
+                chunk['timing'] = known[(chunk['content'], story['content'])]
+                record_result(story_index, chunk_index, ['timing'], chunk['timing'])
+                print(f"Story {story_index + 1} chunk {chunk_index + 1} timing copied from a duplicate chunk: {chunk['timing']}")
                 continue
 
+            jobs.setdefault((chunk['content'], story['content']), []).append((story_index, chunk_index, chunk))
+
+    print(f"\nAnalyzing {len(jobs)} unique chunks...")
+
+    asyncio.run(analyze_jobs(jobs))
+    save_stories(data)
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,81 +1,124 @@
 import streamlit as st
-import json
+import orjson
 import os
 import numpy as np
 from sklearn.decomposition import PCA
-from sklearn.manifold import TSNE
+from openTSNE import TSNE
+from pynndescent import NNDescent
 import plotly.express as px
 import plotly.graph_objects as go
 import pandas as pd
 import umap
 from typing import List, Dict, Tuple
 
-def load_data(viz_params: Dict) -> pd.DataFrame:
-    """Load and prepare data with configurable visualization parameters"""
+TIME_PERIODS = ['beginning', 'middle', 'leaving', 'after']
+
+def add_tactic_flags(df: pd.DataFrame) -> pd.DataFrame:
+    """Replace the raw manipulation_tactics.<tactic> scores with has_<tactic> flags"""
+    scores = df.filter(like='manipulation_tactics.')
+    flags = scores.ge(2).rename(columns=lambda column: 'has_' + column.split('.', 1)[1])
+    return pd.concat([df.drop(columns=scores.columns), flags], axis=1)
+
+@st.cache_data
+def load_data() -> Tuple[pd.DataFrame, np.ndarray]:
+    """Load chunk metadata and embeddings once, reused across reruns"""
     parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
     stories_path = os.path.join(parent_dir, 'stories_smaller_chunks.json')
+    embeddings_path = os.path.join(parent_dir, 'embeddings.npy')
+    chunks_path = os.path.join(parent_dir, 'chunks.parquet')
     
-    with open(stories_path, 'r', encoding='utf-8') as file:
-        data = json.load(file)
+    # Prefer the compact copy written by processing/export_embeddings.py,
+    # unless the stories file has changed since it was exported
+    if (os.path.exists(embeddings_path) and os.path.exists(chunks_path)
+            and os.path.getmtime(embeddings_path) >= os.path.getmtime(stories_path)):
+        return add_tactic_flags(pd.read_parquet(chunks_path)), np.load(embeddings_path)
     
-    rows = []
-    embeddings = []
+    with open(stories_path, 'rb') as file:
+        data = orjson.loads(file.read())
     
+    # Flatten every chunk into a row; nested tactic scores become
+    # manipulation_tactics.<tactic> columns
     for story_idx, story in enumerate(data['stories']):
-        for chunk_idx, chunk in enumerate(story['chunks']):
-            if 'embedding' not in chunk:
-                continue
-                
-            row = {
-                'story_index': story_idx,
-                'chunk_index': chunk_idx,
-                'content': chunk['content'],
-                'timing': chunk.get('timing', 'unknown'),
-            }
-            
-            if 'manipulation_tactics' in chunk:
-                for tactic, score in chunk['manipulation_tactics'].items():
-                    row[f'has_{tactic}'] = bool(score >= 2)
-            
-            rows.append(row)
-            embeddings.append(chunk['embedding'])
+        story['story_index'] = story_idx
+    chunks = pd.json_normalize(data['stories'], record_path='chunks', meta=['story_index'])
+    chunks['story_index'] = chunks['story_index'].astype(int)
+    chunks['chunk_index'] = chunks.groupby('story_index').cumcount()
+    chunks = chunks[chunks['embedding'].notna()].reset_index(drop=True)
     
-    df = pd.DataFrame(rows)
-    embeddings_array = np.array(embeddings)
+    if 'timing' not in chunks:
+        chunks['timing'] = 'unknown'
+    chunks['timing'] = chunks['timing'].fillna('unknown')
     
-    # Generate embeddings with configurable parameters
-    
-    # PCA
+    # float32 halves the memory the reducers stream through; the sidecar is stored the same way
+    embeddings_array = np.array(chunks.pop('embedding').tolist(), dtype=np.float32)
+    columns = ['story_index', 'chunk_index', 'content', 'timing']
+    df = chunks[columns + list(chunks.filter(like='manipulation_tactics.').columns)]
+    return add_tactic_flags(df), embeddings_array
+
+@st.cache_data
+def category_masks() -> Dict[str, np.ndarray]:
+    """Row masks for every time period and tactic, computed once per dataset"""
+    df, _ = load_data()
+    masks = {period: (df['timing'] == period).to_numpy() for period in TIME_PERIODS}
+    for column in df.columns:
+        if column.startswith('has_'):
+            masks[column[len('has_'):]] = df[column].to_numpy(dtype=bool)
+    return masks
+
+# Each reducer is cached on its own parameters, so moving a slider only
+# refits the reduction it belongs to
+
+@st.cache_data
+def reduce_pca(embeddings_array: np.ndarray) -> np.ndarray:
     pca = PCA(
         n_components=2,
         random_state=42
     )
-    df[['PCA1', 'PCA2']] = pca.fit_transform(embeddings_array)
-    
-    # t-SNE
+    return pca.fit_transform(embeddings_array)
+
+@st.cache_data
+def reduce_tsne(embeddings_array: np.ndarray, perplexity: float, early_exaggeration: float,
+                learning_rate: float, n_iter: int) -> np.ndarray:
+    # openTSNE counts the 250 early exaggeration iterations separately,
+    # so subtract them to keep the slider meaning the total
     tsne = TSNE(
         n_components=2,
-        perplexity=viz_params['tsne_perplexity'],
-        early_exaggeration=viz_params['tsne_early_exaggeration'],
-        learning_rate=viz_params['tsne_learning_rate'],
-        n_iter=viz_params['tsne_n_iter'],
+        perplexity=perplexity,
+        early_exaggeration=early_exaggeration,
+        learning_rate=learning_rate,
+        early_exaggeration_iter=250,
+        n_iter=max(n_iter - 250, 0),
+        negative_gradient_method='fft',
+        n_jobs=-1,
         random_state=42
     )
-    df[['TSNE1', 'TSNE2']] = tsne.fit_transform(embeddings_array)
-    
-    # UMAP
+    return np.asarray(tsne.fit(embeddings_array))
+
+@st.cache_data
+def nearest_neighbors(embeddings_array: np.ndarray, n_neighbors: int, metric: str) -> Tuple[np.ndarray, np.ndarray]:
+    """Build the UMAP k-nearest-neighbor graph, shared by every min_dist setting"""
+    index = NNDescent(
+        embeddings_array,
+        n_neighbors=n_neighbors,
+        metric=metric,
+        random_state=42
+    )
+    return index.neighbor_graph
+
+@st.cache_data
+def reduce_umap(embeddings_array: np.ndarray, n_neighbors: int, min_dist: float, metric: str) -> np.ndarray:
     umap_reducer = umap.UMAP(
-        n_neighbors=viz_params['umap_n_neighbors'],
-        min_dist=viz_params['umap_min_dist'],
+        n_neighbors=n_neighbors,
+        min_dist=min_dist,
         n_components=2,
-        metric=viz_params['umap_metric'],
+        metric=metric,
+        precomputed_knn=nearest_neighbors(embeddings_array, n_neighbors, metric),
         random_state=42
     )
-    df[['UMAP1', 'UMAP2']] = umap_reducer.fit_transform(embeddings_array)
-    
-    return df
+    # Embeddings are always finite, so skip UMAP's validation pass
+    return umap_reducer.fit_transform(embeddings_array, ensure_all_finite=False)
 
-def create_plot(df: pd.DataFrame, plot_type: str, selected_categories: List[str]) -> go.Figure:
+def create_plot(df: pd.DataFrame, masks: Dict[str, np.ndarray], plot_type: str, selected_categories: List[str]) -> go.Figure:
     """Create plotly figure based on selected visualization type and categories"""
     
     if plot_type == 'PCA':
@@ -91,7 +134,7 @@ def create_plot(df: pd.DataFrame, plot_type: str, selected_categories: List[str]
     fig = go.Figure()
     
     # Base scatter plot
-    fig.add_trace(go.Scatter(
+    fig.add_trace(go.Scattergl(
         x=df[x_col],
         y=df[y_col],
         mode='markers',
@@ -115,30 +158,30 @@ def create_plot(df: pd.DataFrame, plot_type: str, selected_categories: List[str]
         'triangulation': '#1f77b4'
     }
     
+    # Slice each category's points out in a single .loc
     for category in selected_categories:
-        if category in ['beginning', 'middle', 'leaving', 'after']:
-            mask = df['timing'] == category
-            if mask.any():
-                fig.add_trace(go.Scatter(
-                    x=df[mask][x_col],
-                    y=df[mask][y_col],
+        if category in TIME_PERIODS:
+            points = df.loc[masks[category], [x_col, y_col, 'content']]
+            if not points.empty:
+                fig.add_trace(go.Scattergl(
+                    x=points[x_col],
+                    y=points[y_col],
                     mode='markers',
                     marker=dict(color=colors[category], size=8),
-                    text=df[mask]['content'],
+                    text=points['content'],
                     hovertemplate=f'Content: %{{text}}<br>Time: {category}<br><extra></extra>',
                     name=category.title()
                 ))
         else:
-            column = f'has_{category}'
-            if column in df.columns:
-                mask = df[column]
-                if mask.any():
-                    fig.add_trace(go.Scatter(
-                        x=df[mask][x_col],
-                        y=df[mask][y_col],
+            if category in masks:
+                points = df.loc[masks[category], [x_col, y_col, 'content']]
+                if not points.empty:
+                    fig.add_trace(go.Scattergl(
+                        x=points[x_col],
+                        y=points[y_col],
                         mode='markers',
                         marker=dict(color=colors[category], size=8),
-                        text=df[mask]['content'],
+                        text=points['content'],
                         hovertemplate=f'Content: %{{text}}<br>Tactic: {category.replace("_", " ").title()}<br><extra></extra>',
                         name=category.replace('_', ' ').title()
                     ))
@@ -166,30 +209,32 @@ def main():
     # Sidebar controls for visualization parameters
     st.sidebar.header("Visualization Parameters")
     
-    # t-SNE parameters
-    st.sidebar.subheader("t-SNE Parameters")
-    tsne_params = {
-        'tsne_perplexity': st.sidebar.slider(
-            "Perplexity (balance between local and global structure)",
-            5, 100, 30,
-            help="Higher values consider more neighbors (global structure), lower values focus on local structure"
-        ),
-        'tsne_early_exaggeration': st.sidebar.slider(
-            "Early Exaggeration",
-            1.0, 50.0, 12.0,
-            help="Higher values create more space between clusters"
-        ),
-        'tsne_learning_rate': st.sidebar.slider(
-            "Learning Rate",
-            10.0, 1000.0, 200.0,
-            help="Higher values make the visualization more spread out"
-        ),
-        'tsne_n_iter': st.sidebar.slider(
-            "Number of Iterations",
-            250, 2000, 1000,
-            help="More iterations may improve quality but take longer"
-        )
-    }
+    # t-SNE parameters live in a form so the slow refit only runs when asked for
+    with st.sidebar.form("tsne_parameters"):
+        st.subheader("t-SNE Parameters")
+        tsne_params = {
+            'tsne_perplexity': st.slider(
+                "Perplexity (balance between local and global structure)",
+                5, 100, 30,
+                help="Higher values consider more neighbors (global structure), lower values focus on local structure"
+            ),
+            'tsne_early_exaggeration': st.slider(
+                "Early Exaggeration",
+                1.0, 50.0, 12.0,
+                help="Higher values create more space between clusters"
+            ),
+            'tsne_learning_rate': st.slider(
+                "Learning Rate",
+                10.0, 1000.0, 200.0,
+                help="Higher values make the visualization more spread out"
+            ),
+            'tsne_n_iter': st.slider(
+                "Number of Iterations",
+                250, 2000, 1000,
+                help="More iterations may improve quality but take longer"
+            )
+        }
+        st.form_submit_button("Recompute t-SNE")
     
     # UMAP parameters
     st.sidebar.subheader("UMAP Parameters")
@@ -211,23 +256,37 @@ def main():
         )
     }
     
-    # Combine all visualization parameters
-    viz_params = {**tsne_params, **umap_params}
-    
-    # Load data with current parameters
-    df = load_data(viz_params)
-    
     # Visualization type selector
     viz_type = st.sidebar.radio(
         "Select Visualization Type",
         ["PCA", "t-SNE", "UMAP"]
     )
     
+    # Load data and run only the reduction that is being displayed
+    df, embeddings_array = load_data()
+    if viz_type == 'PCA':
+        df[['PCA1', 'PCA2']] = reduce_pca(embeddings_array)
+    elif viz_type == 't-SNE':
+        df[['TSNE1', 'TSNE2']] = reduce_tsne(
+            embeddings_array,
+            tsne_params['tsne_perplexity'],
+            tsne_params['tsne_early_exaggeration'],
+            tsne_params['tsne_learning_rate'],
+            tsne_params['tsne_n_iter']
+        )
+    else:  # UMAP
+        df[['UMAP1', 'UMAP2']] = reduce_umap(
+            embeddings_array,
+            umap_params['umap_n_neighbors'],
+            umap_params['umap_min_dist'],
+            umap_params['umap_metric']
+        )
+    
     # Category selectors
     st.sidebar.subheader("Categories")
     time_periods = st.sidebar.multiselect(
         "Select Time Periods",
-        ["beginning", "middle", "leaving", "after"],
+        TIME_PERIODS,
         default=[]
     )
     
@@ -240,21 +299,20 @@ def main():
     selected_categories = time_periods + tactics
     
     # Create and display plot
-    fig = create_plot(df, viz_type, selected_categories)
+    masks = category_masks()
+    fig = create_plot(df, masks, viz_type, selected_categories)
     st.plotly_chart(fig, use_container_width=True)
     
     # Display statistics
     st.sidebar.subheader("Statistics")
     if selected_categories:
         for category in selected_categories:
-            if category in ['beginning', 'middle', 'leaving', 'after']:
-                count = (df['timing'] == category).sum()
+            if category in TIME_PERIODS:
+                count = masks[category].sum()
                 st.sidebar.text(f"{category.title()}: {count} chunks")
-            else:
-                column = f'has_{category}'
-                if column in df.columns:
-                    count = df[column].sum()
-                    st.sidebar.text(f"{category.replace('_', ' ').title()}: {count} chunks")
+            elif category in masks:
+                count = masks[category].sum()
+                st.sidebar.text(f"{category.replace('_', ' ').title()}: {count} chunks")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
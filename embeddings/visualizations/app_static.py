@@ -1,117 +1,191 @@
 import streamlit as st
-import json
+import hashlib
 import os
+import ijson
 import numpy as np
-from sklearn.manifold import TSNE
+from sklearn.decomposition import PCA
+from openTSNE import TSNE
 import plotly.graph_objects as go
 import pandas as pd
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
 
-def load_data() -> pd.DataFrame:
-    """Load and prepare data with optimized t-SNE parameters"""
+TIME_PERIODS = ["beginning", "middle", "leaving", "after"]
+TACTICS = ["gaslighting", "silent_treatment", "love_bombing", "projection", "triangulation"]
+# Color scheme for different categories
+COLORS = {
+    'beginning': '#ff7f0e',
+    'middle': '#2ca02c',
+    'leaving': '#d62728',
+    'after': '#9467bd',
+    'gaslighting': '#e377c2',
+    'silent_treatment': '#7f7f7f',
+    'love_bombing': '#bcbd22',
+    'projection': '#17becf',
+    'triangulation': '#1f77b4'
+}
+# Plots with at least this many points render with WebGL instead of SVG
+MIN_WEBGL_POINTS = 1000
+# Hover text shows at most this many characters of each chunk
+HOVER_CHARS = 200
+
+@st.cache_data
+def load_chunks() -> Tuple[pd.DataFrame, np.ndarray]:
+    """Load chunk metadata and embeddings once, reused across reruns"""
     parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
     stories_path = os.path.join(parent_dir, 'stories_smaller_chunks.json')
     
-    with open(stories_path, 'r', encoding='utf-8') as file:
-        data = json.load(file)
-    
-    rows = []
+    columns = {'story_index': [], 'chunk_index': [], 'content': [], 'timing': []}
+    scores = {tactic: [] for tactic in TACTICS}
     embeddings = []
-    
-    for story_idx, story in enumerate(data['stories']):
-        for chunk_idx, chunk in enumerate(story['chunks']):
-            if 'embedding' not in chunk:
-                continue
+    with open(stories_path, 'rb') as file:
+        # Parse one story at a time so the whole file is never in memory at once,
+        # keeping only a float32 copy of each vector
+        for story_idx, story in enumerate(ijson.items(file, 'stories.item', use_float=True)):
+            for chunk_idx, chunk in enumerate(story['chunks']):
+                if 'embedding' not in chunk:
+                    continue
+                embeddings.append(np.asarray(chunk['embedding'], dtype=np.float32))
+                columns['story_index'].append(story_idx)
+                columns['chunk_index'].append(chunk_idx)
+                columns['content'].append(chunk['content'])
+                columns['timing'].append(chunk.get('timing', 'unknown'))
                 
-            row = {
-                'story_index': story_idx,
-                'chunk_index': chunk_idx,
-                'content': chunk['content'],
-                'timing': chunk.get('timing', 'unknown'),
-            }
-            
-            if 'manipulation_tactics' in chunk:
-                for tactic, score in chunk['manipulation_tactics'].items():
-                    row[f'has_{tactic}'] = bool(score >= 2)
-            
-            rows.append(row)
-            embeddings.append(chunk['embedding'])
-    
-    df = pd.DataFrame(rows)
-    embeddings_array = np.array(embeddings)
-    
-    # t-SNE with optimized parameters
-    tsne = TSNE(
-        n_components=2,
-        perplexity=46,
-        early_exaggeration=12,
-        learning_rate=200,
-        n_iter=1200,
-        random_state=42
-    )
-    df[['TSNE1', 'TSNE2']] = tsne.fit_transform(embeddings_array)
+                # Missing scores count as 0
+                tactic_scores = chunk.get('manipulation_tactics', {})
+                for tactic in TACTICS:
+                    scores[tactic].append(tactic_scores.get(tactic, 0))
     
+    embeddings_array = np.stack(embeddings) if embeddings else np.empty((0, 0), dtype=np.float32)
+    
+    # Build every column from the fixed schema in one go; timing repeats a
+    # handful of labels, so it is stored as small integer codes
+    df = pd.DataFrame({
+        'story_index': columns['story_index'],
+        'chunk_index': columns['chunk_index'],
+        'content': columns['content'],
+        'timing': pd.Categorical(columns['timing']),
+        **{f'has_{tactic}': np.asarray(scores[tactic]) >= 2 for tactic in TACTICS}
+    })
+    return df, embeddings_array
+
+# Embeddings are reduced to this many principal components before t-SNE;
+# neighborhoods survive and every distance is ~15x cheaper at 768 dimensions
+PCA_COMPONENTS = 50
+
+# t-SNE with optimized parameters
+TSNE_PARAMS = dict(
+    n_components=2,
+    perplexity=46,
+    early_exaggeration=12,
+    learning_rate=200,
+    # openTSNE counts the early exaggeration phase separately; 1200 iterations in total
+    early_exaggeration_iter=250,
+    n_iter=950,
+    # Barnes-Hut (angle 0.5) below 10k points, FFT interpolation above,
+    # starting from a PCA layout so fewer iterations are spent untangling
+    negative_gradient_method='auto',
+    theta=0.5,
+    initialization='pca',
+    n_jobs=-1,
+    random_state=42
+)
+
+def tsne_cache_path(embeddings_array: np.ndarray) -> str:
+    """Where the t-SNE coordinates for these embeddings and parameters are saved"""
+    parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    key_hash = hashlib.blake2b(embeddings_array.tobytes(), digest_size=16)
+    key_hash.update(repr((PCA_COMPONENTS, sorted(TSNE_PARAMS.items()))).encode())
+    return os.path.join(parent_dir, '.cache', f'tsne_{key_hash.hexdigest()}.parquet')
+
+@st.cache_data(show_spinner="Computing t-SNE...")
+def compute_tsne(embeddings_array: np.ndarray) -> np.ndarray:
+    """Fit t-SNE, reusing coordinates saved by an earlier run on the same embeddings"""
+    cache_path = tsne_cache_path(embeddings_array)
+    if os.path.exists(cache_path):
+        return pd.read_parquet(cache_path).to_numpy()
+    
+    pca = PCA(n_components=min(PCA_COMPONENTS, *embeddings_array.shape), random_state=42)
+    reduced = pca.fit_transform(embeddings_array)
+    tsne = TSNE(**TSNE_PARAMS)
+    coordinates = np.asarray(tsne.fit(reduced))
+    
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    pd.DataFrame(coordinates, columns=['TSNE1', 'TSNE2']).to_parquet(cache_path, compression='zstd')
+    return coordinates
+
+@st.cache_data
+def category_index() -> Dict[str, np.ndarray]:
+    """Row positions for every time period and tactic, computed once per dataset"""
+    df, _ = load_chunks()
+    index = {period: np.flatnonzero((df['timing'] == period).to_numpy()) for period in TIME_PERIODS}
+    index.update({tactic: np.flatnonzero(df[f'has_{tactic}'].to_numpy()) for tactic in TACTICS})
+    return index
+
+def load_data() -> Optional[pd.DataFrame]:
+    """Load and prepare data, or return None while the t-SNE layout waits to be computed"""
+    df, embeddings_array = load_chunks()
+    
+    # Fitting t-SNE takes minutes, so unless a layout is already saved on disk
+    # only start once asked to
+    if not os.path.exists(tsne_cache_path(embeddings_array)):
+        st.info("No saved t-SNE layout for these embeddings yet; computing one takes a few minutes.")
+        if not st.button("Compute t-SNE"):
+            return None
+    
+    df[['TSNE1', 'TSNE2']] = compute_tsne(embeddings_array)
     return df
 
-def create_plot(df: pd.DataFrame, selected_categories: List[str]) -> go.Figure:
+def create_plot(df: pd.DataFrame, index: Dict[str, np.ndarray], selected_categories: List[str]) -> go.Figure:
     """Create plotly figure with t-SNE visualization"""
+    # SVG stays crisper for small plots; WebGL keeps large ones responsive
+    scatter = go.Scattergl if len(df) >= MIN_WEBGL_POINTS else go.Scatter
     fig = go.Figure()
     
-    # Base scatter plot with all points in gray
-    fig.add_trace(go.Scatter(
-        x=df['TSNE1'],
-        y=df['TSNE2'],
+    # Color every point in a single trace: gray by default, with later
+    # selections painting over earlier ones as the stacked traces used to
+    point_colors = np.full(len(df), 'lightgray', dtype=object)
+    point_labels = np.full(len(df), '', dtype=object)
+    legend_categories = []
+    for category in selected_categories:
+        idx = index.get(category)
+        if idx is None or not idx.size:
+            continue
+        
+        point_colors[idx] = COLORS[category]
+        if category in TIME_PERIODS:
+            # Time period categories
+            point_labels[idx] = f'Time: {category}<br>'
+            legend_categories.append((category, category.title()))
+        else:
+            # Manipulation tactics
+            point_labels[idx] = f'Tactic: {category.replace("_", " ").title()}<br>'
+            legend_categories.append((category, category.replace('_', ' ').title()))
+    
+    # Draw the highlighted points last so the gray ones don't cover them
+    order = np.argsort(point_colors != 'lightgray', kind='stable')
+    fig.add_trace(scatter(
+        x=df['TSNE1'].to_numpy()[order],
+        y=df['TSNE2'].to_numpy()[order],
         mode='markers',
-        marker=dict(color='lightgray', size=8),
-        text=df['content'],
-        hovertemplate='Content: %{text}<br><extra></extra>',
+        marker=dict(color=point_colors[order].tolist(), size=8),
+        # Only a preview of each chunk is sent to the browser
+        text=df['content'].str.slice(0, HOVER_CHARS).to_numpy()[order],
+        customdata=point_labels[order],
+        hovertemplate='Content: %{text}<br>%{customdata}<extra></extra>',
         name='All Points',
         showlegend=False
     ))
     
-    # Color scheme for different categories
-    colors = {
-        'beginning': '#ff7f0e',
-        'middle': '#2ca02c',
-        'leaving': '#d62728',
-        'after': '#9467bd',
-        'gaslighting': '#e377c2',
-        'silent_treatment': '#7f7f7f',
-        'love_bombing': '#bcbd22',
-        'projection': '#17becf',
-        'triangulation': '#1f77b4'
-    }
-    
-    # Add selected categories
-    for category in selected_categories:
-        if category in ['beginning', 'middle', 'leaving', 'after']:
-            # Time period categories
-            mask = df['timing'] == category
-            if mask.any():
-                fig.add_trace(go.Scatter(
-                    x=df[mask]['TSNE1'],
-                    y=df[mask]['TSNE2'],
-                    mode='markers',
-                    marker=dict(color=colors[category], size=8),
-                    text=df[mask]['content'],
-                    hovertemplate=f'Content: %{{text}}<br>Time: {category}<br><extra></extra>',
-                    name=category.title()
-                ))
-        else:
-            # Manipulation tactics
-            column = f'has_{category}'
-            if column in df.columns:
-                mask = df[column]
-                if mask.any():
-                    fig.add_trace(go.Scatter(
-                        x=df[mask]['TSNE1'],
-                        y=df[mask]['TSNE2'],
-                        mode='markers',
-                        marker=dict(color=colors[category], size=8),
-                        text=df[mask]['content'],
-                        hovertemplate=f'Content: %{{text}}<br>Tactic: {category.replace("_", " ").title()}<br><extra></extra>',
-                        name=category.replace('_', ' ').title()
-                    ))
+    # Empty traces that only label the category colors in the legend
+    for category, name in legend_categories:
+        fig.add_trace(scatter(
+            x=[None],
+            y=[None],
+            mode='markers',
+            marker=dict(color=COLORS[category], size=8),
+            name=name,
+            hoverinfo='skip'
+        ))
     
     # Update layout
     fig.update_layout(
@@ -141,6 +215,8 @@ def main():
     
     # Load data with optimized parameters
     df = load_data()
+    if df is None:
+        return
     
     # Export leaving points
     #leaving_points = export_leaving_points(df)
@@ -158,32 +234,30 @@ def main():
     
     time_periods = st.sidebar.multiselect(
         "Select Time Periods",
-        ["beginning", "middle", "leaving", "after"],
+        TIME_PERIODS,
         default=[]
     )
     
     tactics = st.sidebar.multiselect(
         "Select Manipulation Tactics",
-        ["gaslighting", "silent_treatment", "love_bombing", "projection", "triangulation"],
+        TACTICS,
         default=[]
     )
     
     selected_categories = time_periods + tactics
-    fig = create_plot(df, selected_categories)
+    index = category_index()
+    fig = create_plot(df, index, selected_categories)
     st.plotly_chart(fig, use_container_width=True)
     
-    # Display statistics
+    # Display statistics, counted from the cached row positions
     st.sidebar.subheader("Statistics")
     if selected_categories:
         for category in selected_categories:
-            if category in ['beginning', 'middle', 'leaving', 'after']:
-                count = (df['timing'] == category).sum()
+            count = len(index.get(category, ()))
+            if category in TIME_PERIODS:
                 st.sidebar.text(f"{category.title()}: {count} chunks")
             else:
-                column = f'has_{category}'
-                if column in df.columns:
-                    count = df[column].sum()
-                    st.sidebar.text(f"{category.replace('_', ' ').title()}: {count} chunks")
+                st.sidebar.text(f"{category.replace('_', ' ').title()}: {count} chunks")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file